@@ -1,10 +1,14 @@
+import os
 import sys
+import contextlib
 import cv2
+import queue
+import threading
+import time
 import serial
 import pickle
 import numpy as np
 from pathlib import Path
-from collections import Counter
 from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLabel, QVBoxLayout, QHBoxLayout
@@ -14,19 +18,100 @@ from rfdeon.response.inventory_all import InventoryAll
 from rfdeon.util.parse_util import bytes_to_hex_readable
 from rfdeon.util.reader_util import get_response_serial
 
+import dlib
 import face_recognition as fr
 
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 ENCODINGS_PATH = Path("output/encodings.isiot")
+# nothing in this repo writes this file: the enrollment tooling has to encode each face with
+# SFACE_MODEL_PATH and pickle {"encodings": [...], "names": [...]} here, same layout as
+# ENCODINGS_PATH, then convert it with --migrate
+SFACE_ENCODINGS_PATH = Path("output/encodings_sface.isiot")
+YUNET_MODEL_PATH = Path("models/face_detection_yunet_2023mar.onnx")
+SFACE_MODEL_PATH = Path("models/face_recognition_sface_2021dec.onnx")
 HISTORY_FILE = "historyy.txt"
 RFID_COM_PORT = "COM5"
 RFID_BAUDRATE = 57600
-
-def load_encodings():
-    if not ENCODINGS_PATH.exists():
+RFID_TIMEOUT = 0.1
+RFID_POLL_INTERVAL = 0.05  # pause between inventory commands so an idle reader doesn't spin
+HISTORY_CHECK_INTERVAL = 20  # RFID polls between checks for an edited history file
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+CAMERA_RETRY_INTERVAL = 0.1
+DETECTION_SCALE = 4
+PROCESS_EVERY_N_FRAMES = 2
+MATCH_TOLERANCE = 0.6
+# "cnn" runs on the GPU when dlib is built with CUDA; override with FACE_DETECTION_MODEL=hog|cnn
+FACE_DETECTION_MODEL = os.environ.get("FACE_DETECTION_MODEL") or ("cnn" if dlib.DLIB_USE_CUDA else "hog")
+# "sface" uses OpenCV's YuNet + SFace ONNX models; its embeddings are not comparable with dlib's,
+# so enrolled faces must be re-encoded with SFace into SFACE_ENCODINGS_PATH
+FACE_BACKEND = os.environ.get("FACE_BACKEND", "dlib")
+# L2 threshold on unit-normalized SFace features, as used by cv2.FaceRecognizerSF.match
+SFACE_MATCH_TOLERANCE = 1.128
+FACE_CACHE_MAX_AGE = 5  # processed frames a cached name is trusted before the face is matched again
+FACE_EMIT_INTERVAL = 1 / 15  # cap UI frame updates at 15 Hz
+
+def migrate_encodings(pickle_path, npz_path):
+    # run via --migrate after enrolling; float16 is plenty for 128-d face embeddings
+    with pickle_path.open("rb") as f:
+        data = pickle.load(f)
+    embeddings = np.asarray(data["encodings"], dtype=np.float16).reshape(-1, 128)
+    np.savez_compressed(npz_path, emb=embeddings, names=np.array(data["names"], dtype=str))
+    print(f"Migrated {pickle_path} to {npz_path}")
+
+def load_encodings(path=ENCODINGS_PATH):
+    npz_path = path.with_suffix(".npz")
+    # enrollment still writes the pickle; converting it is left to --migrate so startup never unpickles
+    if path.exists() and (not npz_path.exists() or path.stat().st_mtime > npz_path.stat().st_mtime):
+        print(f"{path} has enrollments missing from {npz_path}; run with --migrate to convert it.")
+    if not npz_path.exists():
         print("Encoding file not found.")
         return None
-    with ENCODINGS_PATH.open("rb") as f:
-        return pickle.load(f)
+    with np.load(npz_path) as data:
+        encodings = data["emb"].astype(np.float32)
+        names = data["names"].tolist()
+    return {"encodings": np.ascontiguousarray(encodings), "names": names}
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def nn_match(known, queries, max_sq_dist):
+        # fused subtract + square + sum + argmin + threshold, no temporaries; -1 means no match
+        matches = np.full(queries.shape[0], -1, np.int64)
+        for q in range(queries.shape[0]):
+            best = max_sq_dist
+            for i in range(known.shape[0]):
+                sq_dist = 0.0
+                for j in range(known.shape[1]):
+                    diff = known[i, j] - queries[q, j]
+                    sq_dist += diff * diff
+                if sq_dist < best:
+                    best = sq_dist
+                    matches[q] = i
+        return matches
+else:
+    def nn_match(known, queries, max_sq_dist):
+        # |q - k|^2 = |q|^2 - 2 q.k + |k|^2 keeps the bulk of the work in one matmul
+        sq_dists = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ known.T + (known ** 2).sum(axis=1)[None, :]
+        idxs = sq_dists.argmin(axis=1)
+        return np.where(sq_dists[np.arange(len(idxs)), idxs] < max_sq_dist, idxs, -1)
+
+def resolve_face_backend():
+    if FACE_BACKEND != "sface":
+        return "dlib"
+    missing = [str(path) for path in (YUNET_MODEL_PATH, SFACE_MODEL_PATH) if not path.exists()]
+    if missing:
+        print(f"SFace model not found: {', '.join(missing)}. Falling back to dlib.")
+        return "dlib"
+    return "sface"
 
 def load_rfid_history():
     history = {}
@@ -35,97 +120,285 @@ def load_rfid_history():
             for line in file:
                 parts = line.strip().split(" - ")
                 if len(parts) == 2:
-                    tag = parts[0].strip().upper()
-                    history[tag] = parts[1].strip()
+                    history[normalize_tag(parts[0])] = parts[1].strip()
     except FileNotFoundError:
         print("History file not found.")
     return history
 
+def history_mtime():
+    try:
+        return os.stat(HISTORY_FILE).st_mtime
+    except FileNotFoundError:
+        return None
+
+def boxes_overlap(a, b):
+    a_top, a_right, a_bottom, a_left = a
+    b_top, b_right, b_bottom, b_left = b
+    return a_left < b_right and b_left < a_right and a_top < b_bottom and b_top < a_bottom
+
 def normalize_tag(tag: str) -> str:
-    tag = tag.replace(" ", "").upper()
-    return ' '.join(tag[i:i+2] for i in range(0, len(tag), 2))
+    tag = tag.replace(" ", "")
+    try:
+        return bytes.fromhex(tag).hex(" ").upper()
+    except ValueError:
+        # odd length or non-hex text, e.g. a malformed history line
+        tag = tag.upper()
+        return ' '.join(tag[i:i+2] for i in range(0, len(tag), 2))
 
 class FaceRecognitionThread(QThread):
     face_name_signal = pyqtSignal(str, QImage)
 
-    def __init__(self, encodings):
+    def __init__(self, encodings, display_size, backend="dlib"):
         super().__init__()
+        if encodings is None:
+            # no enrolled faces: keep streaming, every face comes back "Unknown"
+            encodings = {"encodings": np.empty((0, 128), np.float32), "names": []}
         self.encodings = encodings
+        self.display_size = display_size
+        self._known = encodings["encodings"]
+        tolerance = MATCH_TOLERANCE
+        # dlib's 0.6 tolerance is calibrated on raw Euclidean distance, so only SFace is normalized
+        self._normalize = False
+        self._detector = self._recognizer = None
+        if backend == "sface":
+            self.load_sface_models()
+            self._known = self._known / np.linalg.norm(self._known, axis=1, keepdims=True)
+            self._normalize = True
+            tolerance = SFACE_MATCH_TOLERANCE
+        self._max_sq_dist = tolerance ** 2
+        self._index = None
+        if faiss is not None and len(self._known):
+            self._index = faiss.IndexFlatL2(self._known.shape[1])
+            self._index.add(self._known)
         self.running = True
+        self._frame_idx = 0
+        self._last_locations = []
+        self._last_names = []
+        # cv2.img_hash ships with opencv-contrib-python only
+        self._use_phash = hasattr(cv2, "img_hash")
+        self._processed = 0
+        self._recent_faces = []  # (location, phash, name, matched_at) from the last processed frame
+        self._last_emit_ts = 0.0
 
     def run(self):
         cap = cv2.VideoCapture(0)
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        frames = queue.Queue(maxsize=1)
+        producer = threading.Thread(target=self.capture_frames, args=(cap, frames), daemon=True)
+        producer.start()
+        try:
+            while self.running:
+                try:
+                    frame = frames.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                if self._frame_idx % PROCESS_EVERY_N_FRAMES == 0:
+                    if self._detector is not None:
+                        locations, faces = self.detect_faces_sface(frame)
+                        encode, image, detections = self.encode_faces_sface, frame, faces
+                    else:
+                        small_frame = cv2.resize(frame, (0, 0), fx=1 / DETECTION_SCALE, fy=1 / DETECTION_SCALE)
+                        rgb_small = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+                        locations = fr.face_locations(rgb_small, model=FACE_DETECTION_MODEL)
+                        encode, image, detections = self.encode_faces_dlib, rgb_small, locations
+
+                    self._last_locations = locations
+                    self._last_names = self.recognize_faces(frame, locations, encode, image, detections)
+                self._frame_idx += 1
+
+                now = time.monotonic()
+                if now - self._last_emit_ts < FACE_EMIT_INTERVAL:
+                    continue
+                self._last_emit_ts = now
+
+                name = self._last_names[0] if self._last_names else "Unknown"
+                for location, face_name in zip(self._last_locations, self._last_names):
+                    top, right, bottom, left = (v * DETECTION_SCALE for v in location)
+                    cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
+                    cv2.putText(frame, face_name, (left, top - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+
+                image = self.convert_cv_qt(self.fit_to_display(frame))
+                self.face_name_signal.emit(name, image)
+        finally:
+            # also runs if detection raises, so the camera is never left open
+            self.running = False
+            producer.join()
+            cap.release()
+
+    def capture_frames(self, cap, frames):
+        # keep only the newest frame so detection never works on a stale one
         while self.running:
             ret, frame = cap.read()
             if not ret:
+                time.sleep(CAMERA_RETRY_INTERVAL)  # camera missing or unplugged
                 continue
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            locations = fr.face_locations(rgb_frame)
-            face_encodings = fr.face_encodings(rgb_frame, locations)
-
-            name = "Unknown"
-            if face_encodings:
-                results = fr.compare_faces(self.encodings["encodings"], face_encodings[0])
-                names = Counter(n for match, n in zip(results, self.encodings["names"]) if match)
-                name = names.most_common(1)[0][0] if names else "Unknown"
-                top, right, bottom, left = locations[0]
-                cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-                cv2.putText(frame, name, (left, top - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-
-            image = self.convert_cv_qt(frame)
-            self.face_name_signal.emit(name, image)
-        cap.release()
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            frames.put_nowait(frame)
+
+    def load_sface_models(self):
+        backend, target = cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU
+        if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+            backend, target = cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA
+        self._detector = cv2.FaceDetectorYN.create(
+            str(YUNET_MODEL_PATH), "", (0, 0), backend_id=backend, target_id=target)
+        self._recognizer = cv2.FaceRecognizerSF.create(
+            str(SFACE_MODEL_PATH), "", backend_id=backend, target_id=target)
+
+    def detect_faces_sface(self, frame):
+        # detect on the downscaled frame; encode_faces_sface aligns on the full-resolution one
+        small_frame = cv2.resize(frame, (0, 0), fx=1 / DETECTION_SCALE, fy=1 / DETECTION_SCALE)
+        self._detector.setInputSize((small_frame.shape[1], small_frame.shape[0]))
+        _, faces = self._detector.detect(small_frame)
+        if faces is None:
+            return [], []
+        locations = [(int(y), int(x + w), int(y + h), int(x)) for x, y, w, h in faces[:, :4]]
+        return locations, faces
+
+    def encode_faces_sface(self, frame, faces, idxs):
+        face_encodings = []
+        for i in idxs:
+            face = faces[i].copy()
+            face[:14] *= DETECTION_SCALE  # box and landmarks, not the score
+            aligned = self._recognizer.alignCrop(frame, face)
+            face_encodings.append(self._recognizer.feature(aligned).flatten())
+        return face_encodings
+
+    def encode_faces_dlib(self, rgb_small, locations, idxs):
+        return fr.face_encodings(rgb_small, [locations[i] for i in idxs])
+
+    def face_hash(self, frame, location):
+        top, right, bottom, left = (max(v * DETECTION_SCALE, 0) for v in location)
+        roi = frame[top:bottom, left:right]
+        if not self._use_phash or roi.size == 0:
+            return None
+        return cv2.img_hash.pHash(roi).tobytes()
+
+    def cached_name(self, location, key):
+        # only trust a hash hit from the same spot in the previous processed frame, and not for long
+        if key is None:
+            return None
+        for prev_location, prev_key, name, matched_at in self._recent_faces:
+            if (prev_key == key and self._processed - matched_at < FACE_CACHE_MAX_AGE
+                    and boxes_overlap(prev_location, location)):
+                return name, matched_at
+        return None
+
+    def recognize_faces(self, frame, locations, encode, image, detections):
+        # a still face hashes the same frame after frame, so a face that stays in place with the
+        # same hash reuses its name for a few processed frames instead of being encoded again
+        self._processed += 1
+        keys = [self.face_hash(frame, location) for location in locations]
+        results = [self.cached_name(location, key) for location, key in zip(locations, keys)]
+        misses = [i for i, hit in enumerate(results) if hit is None]
+        if misses:
+            for i, name in zip(misses, self.match_faces(encode(image, detections, misses))):
+                results[i] = (name, self._processed)
+        # only the previous frame's faces are kept, so no faces in view clears the cache
+        self._recent_faces = [
+            (location, key, name, matched_at)
+            for location, key, (name, matched_at) in zip(locations, keys, results)
+        ]
+        return [name for name, _ in results]
+
+    def match_faces(self, face_encodings):
+        if not len(self._known) or not len(face_encodings):
+            return ["Unknown"] * len(face_encodings)
+        queries = np.vstack(face_encodings).astype(np.float32)
+        if self._normalize:
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        if self._index is not None:
+            # IndexFlatL2 reports squared distances
+            sq_dists, idxs = self._index.search(queries, 1)
+            idxs = np.where(sq_dists[:, 0] < self._max_sq_dist, idxs[:, 0], -1)
+        else:
+            idxs = nn_match(self._known, queries, self._max_sq_dist)
+        names = self.encodings["names"]
+        return [names[idx] if idx >= 0 else "Unknown" for idx in idxs]
 
     def stop(self):
         self.running = False
         self.quit()
         self.wait()
 
+    def fit_to_display(self, frame):
+        h, w = frame.shape[:2]
+        scale = min(self.display_size[0] / w, self.display_size[1] / h)
+        return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
     def convert_cv_qt(self, frame):
+        h, w, ch = frame.shape
+        # copy so the QImage does not alias a buffer the next frame may reuse
+        if hasattr(QImage, "Format_BGR888"):  # Qt 5.14+
+            return QImage(frame.data, w, h, ch * w, QImage.Format_BGR888).copy()
         rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_image.shape
-        return QImage(rgb_image.data, w, h, ch * w, QImage.Format_RGB888)
+        return QImage(rgb_image.data, w, h, ch * w, QImage.Format_RGB888).copy()
 
 class RFIDReaderThread(QThread):
     tag_detected = pyqtSignal(str)
 
+    def __init__(self):
+        super().__init__()
+        self.running = True
+        self._last_emitted = None
+
     def run(self):
         try:
-            ser = serial.Serial(RFID_COM_PORT, baudrate=RFID_BAUDRATE, timeout=2)
-            if not ser.is_open:
-                ser.open()
-
-            history = load_rfid_history()
-            print("[DEBUG] RFID thread running. Waiting for tag...")
-
-            while True:
-                ser.write(Command(CMD_INVENTORY_ALL).serialize())
-                response_bytes = get_response_serial(ser)
-
-                if not response_bytes:
-                    continue  # tidak ada tag, loop lagi
-
-                response = Response(response_bytes)
-                inventory_all = InventoryAll(response.data)
-
-                if inventory_all.tags:
-                    tag_hex = bytes_to_hex_readable(inventory_all.tags[0])
-                    tag_hex = normalize_tag(tag_hex)
-                    print(f"[DEBUG] Tag detected: {tag_hex}")
-                    name = history.get(tag_hex, "Unknown")
-                    print(f"[DEBUG] Name found: {name}")
-                    self.tag_detected.emit(name)
+            # closing() releases the COM port however the loop ends
+            with contextlib.closing(serial.Serial(RFID_COM_PORT, baudrate=RFID_BAUDRATE, timeout=RFID_TIMEOUT)) as ser:
+                loaded_mtime = history_mtime()
+                history = load_rfid_history()
+                print("[DEBUG] RFID thread running. Waiting for tag...")
+
+                polls = 0
+                while self.running:
+                    polls += 1
+                    if polls % HISTORY_CHECK_INTERVAL == 0 and history_mtime() != loaded_mtime:
+                        loaded_mtime = history_mtime()
+                        history = load_rfid_history()
+
+                    time.sleep(RFID_POLL_INTERVAL)
+                    ser.write(Command(CMD_INVENTORY_ALL).serialize())
+                    response_bytes = get_response_serial(ser)
+
+                    if not response_bytes:
+                        continue  # tidak ada tag, loop lagi
+
+                    response = Response(response_bytes)
+                    inventory_all = InventoryAll(response.data)
+
+                    if inventory_all.tags:
+                        tag_hex = bytes_to_hex_readable(inventory_all.tags[0])
+                        tag_hex = normalize_tag(tag_hex)
+                        print(f"[DEBUG] Tag detected: {tag_hex}")
+                        name = history.get(tag_hex, "Unknown")
+                        print(f"[DEBUG] Name found: {name}")
+                        if name != self._last_emitted:
+                            self._last_emitted = name
+                            self.tag_detected.emit(name)
         except Exception as e:
             print(f"[ERROR] {e}")
             self.tag_detected.emit(f"Error: {e}")
 
+    def stop(self):
+        self.running = False
+        self.quit()
+        self.wait()
+
 class SmartDoorSystemGUI(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Smart Door System")
         self.setGeometry(200, 100, 800, 600)
 
-        self.loaded_encodings = load_encodings()
+        self.face_backend = resolve_face_backend()
+        self.loaded_encodings = load_encodings(SFACE_ENCODINGS_PATH if self.face_backend == "sface" else ENCODINGS_PATH)
         self.rfid_history = load_rfid_history()
 
         self.last_face_name = "Unknown"
@@ -183,7 +456,8 @@ class SmartDoorSystemGUI(QMainWindow):
         self.setCentralWidget(central_widget)
 
     def start_threads(self):
-        self.face_thread = FaceRecognitionThread(self.loaded_encodings)
+        display_size = (self.image_label.width(), self.image_label.height())
+        self.face_thread = FaceRecognitionThread(self.loaded_encodings, display_size, self.face_backend)
         self.face_thread.face_name_signal.connect(self.update_face)
         self.face_thread.start()
 
@@ -197,7 +471,7 @@ class SmartDoorSystemGUI(QMainWindow):
     def update_face(self, name, frame_image):
         self.last_face_name = name
         self.name_label.setText(f"Name   : {name}")
-        self.image_label.setPixmap(QPixmap.fromImage(frame_image).scaled(self.image_label.size(), Qt.KeepAspectRatio))
+        self.image_label.setPixmap(QPixmap.fromImage(frame_image))
         self.update_status()
 
     def update_rfid(self, name):
@@ -217,10 +491,16 @@ class SmartDoorSystemGUI(QMainWindow):
         if hasattr(self, 'face_thread'):
             self.face_thread.stop()
         if hasattr(self, 'rfid_thread'):
-            self.rfid_thread.terminate()
+            self.rfid_thread.stop()
         event.accept()
 
 if __name__ == "__main__":
+    if "--migrate" in sys.argv[1:]:
+        for path in (ENCODINGS_PATH, SFACE_ENCODINGS_PATH):
+            if path.exists():
+                migrate_encodings(path, path.with_suffix(".npz"))
+        sys.exit(0)
+
     app = QApplication(sys.argv)
     window = SmartDoorSystemGUI()
     window.show()